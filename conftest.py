@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture
+def tmp_storage(tmp_path, monkeypatch):
+    """Point repo_chat's index storage at a per-test directory."""
+    monkeypatch.setattr("repo_chat.STORAGE_ROOT", str(tmp_path))
+    return tmp_path
@@ -1,16 +1,33 @@
 import argparse
-import json
+import asyncio
+import base64
+import importlib
+import logging
 import os
 import re
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+import orjson
 import requests
 from dotenv import load_dotenv
-from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
-from llama_index.readers.github import GithubRepositoryReader, GithubClient
 
-GITHUB_URL_PATTERN = re.compile(r"^https?://github\.com/[^/]+/[^/]+/?$")
+logger = logging.getLogger("repo_chat")
+
+GITHUB_URL_PATTERN = re.compile(r"^https?://github\.com/([^/]+)/([^/]+?)/?$")
 GITHUB_API_TIMEOUT = 10
+# Shared session keeps the connection to api.github.com alive between calls
+GITHUB_SESSION = requests.Session()
+GIT_CLONE_TIMEOUT = 300
+# Recorded in metadata.json; an index built with other values is rebuilt
+EMBED_MODEL = "text-embedding-3-small"
+VECTOR_STORE_KIND = "faiss"
+# Per-repository indexes are persisted under this directory
+STORAGE_ROOT = "./storage"
+HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".config", "repo_chat", "history")
 
 
 def parse_repo_url(url: str) -> tuple[str, str]:
@@ -22,25 +39,41 @@ def parse_repo_url(url: str) -> tuple[str, str]:
     if not normalized_url.startswith(("http://", "https://")):
         normalized_url = f"https://{normalized_url}"
 
-    if not validate_github_url(normalized_url):
+    match = GITHUB_URL_PATTERN.fullmatch(normalized_url)
+    if not match:
         raise ValueError(
             "Invalid GitHub repository URL. Use format: https://github.com/owner/repo"
         )
 
-    owner, repo = normalized_url.rstrip("/").split("/")[-2:]
-    repo = repo.removesuffix(".git")
-    return owner, repo
+    owner, repo = match.groups()
+    return owner, repo.removesuffix(".git")
+
 
+def get_latest_commit_sha(
+    github_token: str,
+    owner: str,
+    repo: str,
+    known_sha: str | None = None,
+    etag: str | None = None,
+) -> tuple[str | None, str | None]:
+    """
+    Get the latest commit SHA for the repository along with the response ETag.
 
-def get_latest_commit_sha(github_token: str, owner: str, repo: str) -> str | None:
-    """Get the latest commit SHA for the repository."""
+    When the ETag of a previous lookup is given, the request is conditional:
+    GitHub answers 304 Not Modified without a body or rate-limit cost, and
+    known_sha is returned unchanged.
+    """
     url = f"https://api.github.com/repos/{owner}/{repo}/branches/main"
     headers = {"Authorization": f"token {github_token}"} if github_token else {}
+    if etag:
+        headers["If-None-Match"] = etag
 
     try:
-        response = requests.get(url, headers=headers, timeout=GITHUB_API_TIMEOUT)
+        response = GITHUB_SESSION.get(url, headers=headers, timeout=GITHUB_API_TIMEOUT)
+        if response.status_code == 304:
+            return known_sha, etag
         if response.status_code != 200:
-            return None
+            return None, None
 
         payload = response.json()
         if (
@@ -48,54 +81,168 @@ def get_latest_commit_sha(github_token: str, owner: str, repo: str) -> str | Non
             and isinstance(payload.get("commit"), dict)
             and isinstance(payload["commit"].get("sha"), str)
         ):
-            return payload["commit"]["sha"]
-        return None
+            return payload["commit"]["sha"], response.headers.get("ETag")
+        return None, None
     except (requests.RequestException, ValueError, TypeError):
-        return None
+        return None, None
+
+def needs_reindex(
+    storage_dir: str, github_token: str, owner: str, repo: str
+) -> tuple[bool, str | None, str | None]:
+    """
+    Check if repository needs reindexing based on latest commit.
 
-def needs_reindex(storage_dir: str, github_token: str, owner: str, repo: str) -> bool:
-    """Check if repository needs reindexing based on latest commit."""
+    Returns the decision together with the latest commit SHA and its ETag when
+    they had to be fetched, so callers can record them without a second API
+    request.
+    """
     metadata_file = os.path.join(storage_dir, "metadata.json")
     
     if not os.path.exists(metadata_file):
-        return True
+        return True, None, None
     
     try:
-        with open(metadata_file, "r", encoding="utf-8") as f:
-            metadata = json.load(f)
+        with open(metadata_file, "rb") as f:
+            metadata = orjson.loads(f.read())
         
+        # Indexes built with another embedding model or vector store can't be reused
+        if (
+            metadata.get("embed_model") != EMBED_MODEL
+            or metadata.get("vector_store") != VECTOR_STORE_KIND
+        ):
+            return True, None, None
+
         stored_sha = metadata.get("last_commit_sha")
-        current_sha = get_latest_commit_sha(github_token, owner, repo)
+        current_sha, etag = get_latest_commit_sha(
+            github_token, owner, repo, known_sha=stored_sha, etag=metadata.get("etag")
+        )
         
-        return stored_sha != current_sha
+        return stored_sha != current_sha, current_sha, etag
     except Exception:
-        return True
-
-def save_metadata(storage_dir: str, github_token: str, owner: str, repo: str) -> None:
-    """Save repository metadata including latest commit SHA."""
+        return True, None, None
+
+def save_metadata(
+    storage_dir: str,
+    commit_sha: str | None,
+    owner: str,
+    repo: str,
+    etag: str | None = None,
+) -> None:
+    """Save repository metadata including the indexed commit SHA."""
     metadata = {
-        "last_commit_sha": get_latest_commit_sha(github_token, owner, repo),
+        "last_commit_sha": commit_sha,
+        "etag": etag,
         "last_indexed": datetime.now(timezone.utc).isoformat(),
+        "embed_model": EMBED_MODEL,
+        "vector_store": VECTOR_STORE_KIND,
         "owner": owner,
         "repo": repo
     }
     
     metadata_file = os.path.join(storage_dir, "metadata.json")
-    with open(metadata_file, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+    with open(metadata_file, "wb") as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+
+def _clone_repo(owner: str, repo: str, github_token: str, dest_dir: str) -> None:
+    """Shallow-clone the main branch of a GitHub repository into dest_dir."""
+    clone_url = f"https://github.com/{owner}/{repo}.git"
+    command = [
+        "git", "clone", "--depth=1", "--single-branch", "--branch", "main",
+        clone_url, dest_dir,
+    ]
+    # Hand the token to git through its environment so it never shows up in
+    # the process list or in the clone's .git/config
+    credentials = base64.b64encode(f"x-access-token:{github_token}".encode()).decode()
+    env = {
+        **os.environ,
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": "http.extraHeader",
+        "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}",
+        "GIT_TERMINAL_PROMPT": "0",
+    }
+
+    try:
+        subprocess.run(
+            command,
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=GIT_CLONE_TIMEOUT,
+            env=env,
+        )
+    except FileNotFoundError as e:
+        raise RuntimeError("git executable not found. Please install git.") from e
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"Cloning {owner}/{repo} timed out.") from e
+    except subprocess.CalledProcessError as e:
+        # Never echo the token back through the error message
+        stderr = (e.stderr or "").replace(github_token, "***").replace(credentials, "***").strip()
+        raise RuntimeError(f"Failed to clone {owner}/{repo}: {stderr}") from None
+
+def _head_commit_sha(repo_dir: str) -> str:
+    """Return the SHA of the commit checked out in repo_dir."""
+    result = subprocess.run(
+        ["git", "-C", repo_dir, "rev-parse", "HEAD"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+def load_repo_documents(owner: str, repo: str, github_token: str) -> tuple[list, str]:
+    """
+    Clone the repository to a temporary directory and load its files as documents.
+
+    Returns the documents together with the SHA of the cloned commit, which is
+    exactly the content being indexed.
+    """
+    import repo_index
+
+    with tempfile.TemporaryDirectory(prefix="repo_chat_") as clone_dir:
+        _clone_repo(owner, repo, github_token, clone_dir)
+        return repo_index.load_documents(clone_dir), _head_commit_sha(clone_dir)
 
 def validate_github_url(url: str) -> bool:
     """Validate that the URL is a valid GitHub repository URL."""
     return bool(GITHUB_URL_PATTERN.fullmatch(url.strip()))
 
+def _make_prompt():
+    """
+    Return a function that reads a line of input.
+
+    Uses prompt_toolkit with a persistent history and suggestions when it is
+    installed and stdin is a terminal; otherwise falls back to input(), with
+    readline line editing where available.
+    """
+    try:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+        from prompt_toolkit.history import FileHistory
+    except ImportError:
+        PromptSession = None
+
+    if PromptSession is None or not sys.stdin.isatty():
+        try:
+            import readline  # noqa: F401 - enables line editing for input()
+        except ImportError:
+            pass
+        return input
+
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    session = PromptSession(
+        history=FileHistory(HISTORY_FILE), auto_suggest=AutoSuggestFromHistory()
+    )
+    return session.prompt
+
 def interactive_mode():
     """Run the application in interactive mode, prompting for input."""
     print("🤖 Welcome to RepoChat - Interactive Mode")
     print("=" * 50)
+    prompt = _make_prompt()
     
     # Get repository URL
     while True:
-        repo_url = input("\n📁 Enter GitHub repository URL: ").strip()
+        repo_url = prompt("\n📁 Enter GitHub repository URL: ").strip()
         if not repo_url:
             print("❌ URL cannot be empty. Please try again.")
             continue
@@ -111,13 +258,14 @@ def interactive_mode():
     
     # Get question
     while True:
-        question = input("\n❓ What would you like to know about this repository? ").strip()
+        question = prompt("\n❓ What would you like to know about this repository? ").strip()
         if question:
             break
         print("❌ Question cannot be empty. Please try again.")
     
     # Ask about force reindex
     force_reindex = False
+    # Plain input() on purpose: y/N answers would only clutter the history
     reindex_input = input("\n🔄 Force reindex? (y/N): ").strip().lower()
     if reindex_input in ['y', 'yes']:
         force_reindex = True
@@ -130,13 +278,13 @@ def interactive_mode():
     
     # Run the chat function
     try:
-        chat_with_github_repo(repo_url, question, force_reindex)
+        asyncio.run(chat_with_github_repo(repo_url, question, force_reindex))
     except KeyboardInterrupt:
         print("\n\n👋 Thanks for using RepoChat!")
     except Exception as e:
         print(f"\n❌ Error: {e}")
 
-def chat_with_github_repo(repo_url: str, question: str, force_reindex: bool = False):
+async def chat_with_github_repo(repo_url: str, question: str, force_reindex: bool = False):
     """
     Clones a GitHub repository, indexes its content, and answers a question
     about it using an AI model.
@@ -150,10 +298,17 @@ def chat_with_github_repo(repo_url: str, question: str, force_reindex: bool = Fa
     load_dotenv()
 
     # Check if the OpenAI API key is set
-    if not os.getenv("OPENAI_API_KEY"):
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
         raise ValueError("OpenAI API key not found. Please set it in your .env file.")
 
-    # Get GitHub token (optional for public repos, but required by LlamaIndex)
+    # Optional extra keys spread embedding requests across several rate limits
+    extra_keys = (os.getenv("OPENAI_API_KEYS") or "").split(",")
+    openai_api_keys = list(dict.fromkeys(
+        [openai_api_key] + [key.strip() for key in extra_keys if key.strip()]
+    ))
+
+    # Get GitHub token (used for cloning and commit lookups)
     github_token = os.getenv("GITHUB_TOKEN")
     if not github_token:
         raise ValueError(
@@ -165,74 +320,91 @@ def chat_with_github_repo(repo_url: str, question: str, force_reindex: bool = Fa
     # Extract owner and repo name from the URL
     owner, repo = parse_repo_url(repo_url)
 
-    # Initialize GitHub client with token
-    github_client = GithubClient(github_token=github_token, verbose=False)
-
     # Create storage directory for this repository
-    storage_dir = f"./storage/{owner}_{repo}"
+    storage_dir = os.path.join(STORAGE_ROOT, f"{owner}_{repo}")
 
-    # Check if index needs to be created or updated
-    should_reindex = (
-        force_reindex
-        or not os.path.exists(storage_dir)
-        or needs_reindex(storage_dir, github_token, owner, repo)
+    # Import the indexing stack while the commit lookup is in flight
+    import_task = asyncio.create_task(
+        asyncio.to_thread(importlib.import_module, "repo_index")
     )
 
+    # Check if index needs to be created or updated
+    current_sha, etag = None, None
+    should_reindex = force_reindex or not os.path.exists(storage_dir)
     if not should_reindex:
-        print(f"Loading existing index for {owner}/{repo}...")
-        # Load existing index
-        storage_context = StorageContext.from_defaults(persist_dir=storage_dir)
-        index = load_index_from_storage(storage_context)
-        print("Index loaded from storage.")
-    else:
-        if os.path.exists(storage_dir):
-            print(f"Repository {owner}/{repo} has been updated. Reindexing...")
-        else:
-            print(f"Creating new index for {owner}/{repo}...")
-
-        # Instantiate the reader with the repository details
-        loader = GithubRepositoryReader(
-            github_client=github_client,
-            owner=owner,
-            repo=repo,
-            use_parser=False,
-            verbose=False,
+        should_reindex, current_sha, etag = await asyncio.to_thread(
+            needs_reindex, storage_dir, github_token, owner, repo
         )
 
-        # Load the repository data
-        print(f"Loading repository: {repo_url}...")
-        documents = loader.load_data(branch="main")
-        print("Repository loaded successfully.")
-
-        # Create an index from the loaded documents
-        print("Creating index...")
-        index = VectorStoreIndex.from_documents(documents)
-        print("Index created successfully.")
-
-        # Persist index to disk
-        print("Saving index to storage...")
-        os.makedirs(storage_dir, exist_ok=True)
-        index.storage_context.persist(persist_dir=storage_dir)
-
-        # Save metadata
-        save_metadata(storage_dir, github_token, owner, repo)
-        print(f"Index saved to {storage_dir}")
-
-    # Create a query engine from the index
-    query_engine = index.as_query_engine(
-        response_mode="tree_summarize",
-        similarity_top_k=10,
-        streaming=False,
-        verbose=False
+    repo_index = await import_task
+    # Loading the cross-encoder is slow; do it while the index loads or builds.
+    # A dedicated executor keeps it from holding a worker the clone, API and
+    # FAISS calls need, and lets an early failure abandon it without waiting
+    reranker_executor = ThreadPoolExecutor(max_workers=1)
+    reranker_future = asyncio.get_running_loop().run_in_executor(
+        reranker_executor, repo_index.load_reranker
     )
-
-    # Query the engine with the user question
-    print("Asking the AI your question...")
-    response = query_engine.query(question)
-
-    # Print the response
-    print("\nAI Response:")
-    print(response)
+    try:
+        # The same embedding model must serve indexing and querying
+        repo_index.configure_embeddings(openai_api_keys, storage_dir, EMBED_MODEL)
+
+        if not should_reindex:
+            logger.info("Loading existing index for %s/%s...", owner, repo)
+            # Load existing index
+            index = repo_index.load_index(storage_dir)
+            logger.info("Index loaded from storage.")
+        else:
+            if os.path.exists(storage_dir):
+                logger.info("Repository %s/%s has been updated. Reindexing...", owner, repo)
+            else:
+                logger.info("Creating new index for %s/%s...", owner, repo)
+
+            # Clone the repository and load its files
+            logger.info("Loading repository: %s...", repo_url)
+            if current_sha is None:
+                # Fetch the branch ETag while the clone is in flight
+                (documents, indexed_sha), (current_sha, etag) = await asyncio.gather(
+                    asyncio.to_thread(load_repo_documents, owner, repo, github_token),
+                    asyncio.to_thread(get_latest_commit_sha, github_token, owner, repo),
+                )
+            else:
+                documents, indexed_sha = await asyncio.to_thread(
+                    load_repo_documents, owner, repo, github_token
+                )
+            # A push between the API call and the clone makes the ETag describe
+            # another commit; dropping it forces a full check next time
+            if current_sha != indexed_sha:
+                etag = None
+            logger.info("Repository loaded successfully.")
+
+            # Embed first (batches run concurrently) so quantized indexes can be
+            # trained on the full set of vectors before they are added
+            logger.info("Creating index...")
+            nodes = await repo_index.embed_documents(documents)
+            index = await asyncio.to_thread(repo_index.build_index, nodes)
+            logger.info("Index created successfully.")
+
+            # Persist index to disk
+            logger.info("Saving index to storage...")
+            os.makedirs(storage_dir, exist_ok=True)
+            index.storage_context.persist(persist_dir=storage_dir)
+
+            # Save metadata
+            save_metadata(storage_dir, indexed_sha, owner, repo, etag)
+            logger.info("Index saved to %s", storage_dir)
+
+        # Create a query engine from the index
+        query_engine = repo_index.create_query_engine(index, await reranker_future)
+
+        # Query the engine with the user question
+        logger.info("Asking the AI your question...")
+        response = await query_engine.aquery(question)
+
+        # Print the response as tokens arrive
+        print("\nAI Response:")
+        await response.print_response_stream()
+    finally:
+        reranker_executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     # Set up argument parser
@@ -260,6 +432,12 @@ if __name__ == "__main__":
     # Parse arguments
     args = parser.parse_args()
 
+    # Progress messages go to stderr; stdout carries the answer
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.INFO)
+
     # Check if interactive mode or if no arguments provided
     if args.interactive or (not args.repo_url and not args.question):
         interactive_mode()
@@ -269,4 +447,4 @@ if __name__ == "__main__":
             parser.error("Both repo_url and question are required when not using interactive mode")
         
         # Run the chat function
-        chat_with_github_repo(args.repo_url, args.question, args.force_reindex)
+        asyncio.run(chat_with_github_repo(args.repo_url, args.question, args.force_reindex))
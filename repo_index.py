@@ -0,0 +1,420 @@
+"""Index building and querying for RepoChat.
+
+Kept separate from repo_chat so the slow llama-index and FAISS imports are only
+paid once a repository is actually indexed or queried.
+"""
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+
+import faiss
+import fsspec
+import numpy as np
+import orjson
+from llama_index.core import (
+    Document,
+    Settings,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.schema import MetadataMode
+from llama_index.core.postprocessor import SentenceTransformerRerank
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.types import DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME
+from llama_index.core.storage.kvstore import SimpleKVStore
+from llama_index.core.vector_stores.simple import DEFAULT_VECTOR_STORE, NAMESPACE_SEP
+from llama_index.core.vector_stores.types import DEFAULT_PERSIST_FNAME
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.embeddings.openai.base import aget_embeddings
+from openai import AsyncOpenAI
+from llama_index.vector_stores.faiss import FaissVectorStore
+
+logger = logging.getLogger("repo_chat.index")
+
+EMBED_BATCH_SIZE = 100
+EMBED_NUM_WORKERS = 8
+EMBED_CACHE_FILE = "embed_cache.sqlite"
+EMBED_DIM = 1536
+# File the storage context persists the FAISS index to
+FAISS_INDEX_FILE = f"{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+# HNSW graph parameters: neighbours per node and candidate list sizes
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 64
+# IVF-PQ parameters: coarse clusters, probed clusters, sub-quantizers, bits per code
+IVF_NLIST = 256
+IVF_NPROBE = 16
+PQ_M = 48
+PQ_NBITS = 8
+# FAISS wants ~39 training points per centroid for stable k-means
+IVFPQ_MIN_VECTORS = 39 * IVF_NLIST
+SIMILARITY_TOP_K = 10
+# With a reranker, retrieve more candidates and keep only the best few
+RERANK_CANDIDATES = 20
+RERANK_TOP_N = 4
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# Files that carry no useful text for question answering.
+IGNORED_SUFFIXES = (
+    ".png", ".jpg", ".jpeg", ".gif", ".ico", ".svg", ".webp",
+    ".pdf", ".zip", ".tar", ".gz", ".jar",
+    ".woff", ".woff2", ".ttf", ".eot",
+    ".so", ".dll", ".exe", ".pyc",
+    ".min.js", ".min.css", ".map", ".lock",
+)
+IGNORED_FILE_NAMES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock"}
+IGNORED_DIR_NAMES = {".git", "node_modules", "vendor"}
+MAX_FILE_BYTES = 200_000
+# A NUL byte in the first block marks a file as binary
+BINARY_SNIFF_BYTES = 4096
+
+
+class OrjsonKVStore(SimpleKVStore):
+    """
+    In-memory key-value store persisted with orjson instead of the json module.
+
+    Used for the docstore, which holds every chunk's text and metadata and is by
+    far the largest file written on persist. The file format is unchanged, so
+    existing indexes load as before.
+    """
+
+    def persist(self, persist_path: str, fs: fsspec.AbstractFileSystem | None = None) -> None:
+        fs = fs or fsspec.filesystem("file")
+        dirpath = os.path.dirname(persist_path)
+        if not fs.exists(dirpath):
+            fs.makedirs(dirpath)
+        with fs.open(persist_path, "wb") as f:
+            f.write(orjson.dumps(self._collections_mappings))
+
+    @classmethod
+    def from_persist_path(
+        cls, persist_path: str, fs: fsspec.AbstractFileSystem | None = None
+    ) -> "OrjsonKVStore":
+        fs = fs or fsspec.filesystem("file")
+        with fs.open(persist_path, "rb") as f:
+            return cls(orjson.loads(f.read()))
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """
+    OpenAI embedding model backed by a persistent SQLite cache.
+
+    Chunk embeddings are keyed on a hash of the chunk text, so reindexing a
+    repository only sends new or modified chunks to the API. Duplicate chunks
+    within a batch are embedded once. When several API keys are given, uncached
+    batches are spread round-robin across them, each key allowing at most
+    EMBED_NUM_WORKERS requests in flight.
+    """
+
+    _cache_path: str = PrivateAttr()
+    _cache_conn: sqlite3.Connection | None = PrivateAttr(default=None)
+    _cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _api_keys: list[str] = PrivateAttr()
+    _key_slots: itertools.cycle | None = PrivateAttr(default=None)
+
+    def __init__(self, cache_path: str, api_keys: list[str] | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self._cache_path = cache_path
+        self._api_keys = list(api_keys or [])
+
+    def _cache(self) -> sqlite3.Connection:
+        """Return the cache connection, opening it and creating the table on first use."""
+        if self._cache_conn is None:
+            os.makedirs(os.path.dirname(self._cache_path) or ".", exist_ok=True)
+            # Cache I/O runs in worker threads; _cache_lock serializes it
+            conn = sqlite3.connect(self._cache_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key BLOB NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, key))"
+            )
+            self._cache_conn = conn
+        return self._cache_conn
+
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _load_cached(self, texts: list[str]) -> tuple[list, list[int]]:
+        """Return cached embeddings (None where missing) and the missing indices."""
+        keys = [self._cache_key(text) for text in texts]
+        unique_keys = list(set(keys))
+        placeholders = ", ".join("?" * len(unique_keys))
+        with self._cache_lock:
+            rows = self._cache().execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                (self.model_name, *unique_keys),
+            ).fetchall()
+        found = {key: array("f", vector).tolist() for key, vector in rows}
+
+        embeddings = [found.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def _store_cached(self, texts: list[str], embeddings: list[list[float]]) -> None:
+        with self._cache_lock, self._cache() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)",
+                [
+                    (self.model_name, self._cache_key(text), array("f", embedding).tobytes())
+                    for text, embedding in zip(texts, embeddings)
+                ],
+            )
+
+    def prune_cache(self, texts: list[str]) -> None:
+        """Drop cached embeddings for anything but the given texts under this model."""
+        keep = [(self._cache_key(text),) for text in set(texts)]
+        with self._cache_lock, self._cache() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_keys (key BLOB PRIMARY KEY)")
+            conn.execute("DELETE FROM keep_keys")
+            conn.executemany("INSERT INTO keep_keys (key) VALUES (?)", keep)
+            conn.execute(
+                "DELETE FROM embeddings "
+                "WHERE model != ? OR key NOT IN (SELECT key FROM keep_keys)",
+                (self.model_name,),
+            )
+
+    def get_text_embedding_batch(
+        self, texts: list[str], show_progress: bool = False, **kwargs
+    ) -> list[list[float]]:
+        # Identical chunks (license headers, boilerplate) are embedded once
+        unique_texts = list(dict.fromkeys(texts))
+        embeddings = super().get_text_embedding_batch(unique_texts, show_progress, **kwargs)
+        by_text = dict(zip(unique_texts, embeddings))
+        return [by_text[text] for text in texts]
+
+    async def aget_text_embedding_batch(
+        self, texts: list[str], show_progress: bool = False, **kwargs
+    ) -> list[list[float]]:
+        unique_texts = list(dict.fromkeys(texts))
+        embeddings = await super().aget_text_embedding_batch(
+            unique_texts, show_progress, **kwargs
+        )
+        by_text = dict(zip(unique_texts, embeddings))
+        return [by_text[text] for text in texts]
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        embeddings, missing = self._load_cached(texts)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            fresh = super()._get_text_embeddings(missing_texts)
+            self._store_cached(missing_texts, fresh)
+            for i, embedding in zip(missing, fresh):
+                embeddings[i] = embedding
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        # Keep SQLite off the event loop so other batches' requests keep flowing
+        embeddings, missing = await asyncio.to_thread(self._load_cached, texts)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            fresh = await self._aembed_uncached(missing_texts)
+            await asyncio.to_thread(self._store_cached, missing_texts, fresh)
+            for i, embedding in zip(missing, fresh):
+                embeddings[i] = embedding
+        return embeddings
+
+    def _next_key_slot(self) -> tuple[AsyncOpenAI, asyncio.Semaphore]:
+        if self._key_slots is None:
+            credentials = self._get_credential_kwargs(is_async=True)
+            self._key_slots = itertools.cycle([
+                (AsyncOpenAI(**{**credentials, "api_key": key}), asyncio.Semaphore(EMBED_NUM_WORKERS))
+                for key in self._api_keys
+            ])
+        return next(self._key_slots)
+
+    async def _aembed_uncached(self, texts: list[str]) -> list[list[float]]:
+        if len(self._api_keys) < 2:
+            return await super()._aget_text_embeddings(texts)
+
+        aclient, semaphore = self._next_key_slot()
+
+        @self._create_retry_decorator()
+        async def _retryable_aget_embeddings():
+            return await aget_embeddings(
+                aclient, texts, engine=self._text_engine, **self.additional_kwargs
+            )
+
+        async with semaphore:
+            return await _retryable_aget_embeddings()
+
+
+def _is_source_file(path: str) -> bool:
+    """Check whether a file is worth indexing: text, not generated, not too large."""
+    name = os.path.basename(path)
+    if name in IGNORED_FILE_NAMES or name.lower().endswith(IGNORED_SUFFIXES):
+        return False
+    # Symlinks may point outside the checkout
+    if os.path.islink(path):
+        return False
+
+    try:
+        if os.path.getsize(path) > MAX_FILE_BYTES:
+            return False
+        with open(path, "rb") as f:
+            return b"\0" not in f.read(BINARY_SNIFF_BYTES)
+    except OSError:
+        return False
+
+def _find_source_files(repo_dir: str) -> list[str]:
+    """List indexable files, skipping git metadata and vendored directories."""
+    paths = []
+    for root, dir_names, file_names in os.walk(repo_dir):
+        dir_names[:] = [d for d in dir_names if d not in IGNORED_DIR_NAMES]
+        for name in file_names:
+            path = os.path.join(root, name)
+            if _is_source_file(path):
+                paths.append(path)
+    return sorted(paths)
+
+def load_documents(repo_dir: str) -> list:
+    """
+    Load the indexable files of a checked-out repository as documents.
+
+    Every file is read as plain text, like the GitHub reader did, so formats
+    such as notebooks or CSV never go through format-specific parsers.
+    """
+    documents = []
+    for path in _find_source_files(repo_dir):
+        with open(path, "rb") as f:
+            text = f.read().decode("utf-8", errors="ignore")
+        documents.append(Document(
+            text=text,
+            # Mirror the GitHub reader: paths relative to the repository root
+            metadata={
+                "file_path": os.path.relpath(path, repo_dir).replace(os.sep, "/"),
+                "file_name": os.path.basename(path),
+            },
+        ))
+    return documents
+
+def configure_embeddings(openai_api_keys: list[str], storage_dir: str, model: str) -> None:
+    """
+    Use batched, concurrent and cached OpenAI embedding requests for indexing and queries.
+
+    The first key is the primary one; any further keys share the embedding load.
+    """
+    Settings.embed_model = CachedOpenAIEmbedding(
+        cache_path=os.path.join(storage_dir, EMBED_CACHE_FILE),
+        api_keys=openai_api_keys,
+        model=model,
+        api_key=openai_api_keys[0],
+        embed_batch_size=EMBED_BATCH_SIZE,
+        # Each key has its own rate limit, so concurrency scales with the key count
+        num_workers=EMBED_NUM_WORKERS * len(openai_api_keys),
+    )
+
+def create_vector_store(embeddings: list[list[float]]) -> FaissVectorStore:
+    """
+    Create an empty FAISS vector store suited to the given embeddings.
+
+    Small repositories get an HNSW graph over full-precision vectors. Once there
+    are enough vectors to train it, an IVF index with product-quantized codes is
+    used instead, which shrinks the bytes scanned per query by more than 10x.
+    """
+    if len(embeddings) >= IVFPQ_MIN_VECTORS:
+        quantizer = faiss.IndexFlatL2(EMBED_DIM)
+        faiss_index = faiss.IndexIVFPQ(quantizer, EMBED_DIM, IVF_NLIST, PQ_M, PQ_NBITS)
+        faiss_index.train(np.asarray(embeddings, dtype="float32"))
+        faiss_index.nprobe = IVF_NPROBE
+    else:
+        faiss_index = faiss.IndexHNSWFlat(EMBED_DIM, HNSW_M)
+        faiss_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+    return FaissVectorStore(faiss_index=faiss_index)
+
+async def embed_documents(documents: list) -> list:
+    """
+    Split documents into nodes and embed them with the configured model.
+
+    Cached embeddings not used by the new nodes are pruned afterwards, so the
+    cache tracks the current state of the repository.
+    """
+    pipeline = IngestionPipeline(
+        transformations=[*Settings.transformations, Settings.embed_model],
+        disable_cache=True,
+    )
+    nodes = await pipeline.arun(documents=documents, show_progress=True)
+
+    # Forget embeddings of chunks that are no longer part of the repository
+    embed_model = Settings.embed_model
+    if isinstance(embed_model, CachedOpenAIEmbedding):
+        await asyncio.to_thread(
+            embed_model.prune_cache,
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes],
+        )
+    return nodes
+
+def build_index(nodes: list) -> VectorStoreIndex:
+    """Build a vector index over already-embedded nodes."""
+    vector_store = create_vector_store([node.embedding for node in nodes])
+    storage_context = StorageContext.from_defaults(
+        vector_store=vector_store, docstore=SimpleDocumentStore(OrjsonKVStore())
+    )
+    return VectorStoreIndex(nodes, storage_context=storage_context)
+
+def load_index(storage_dir: str) -> VectorStoreIndex:
+    """
+    Load a persisted index and its FAISS vector store.
+
+    The vectors are memory-mapped read-only rather than copied into RAM, so
+    only the pages a search actually touches are read from disk.
+    """
+    faiss_index = faiss.read_index(
+        os.path.join(storage_dir, FAISS_INDEX_FILE),
+        faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY,
+    )
+    docstore = SimpleDocumentStore(
+        OrjsonKVStore.from_persist_path(os.path.join(storage_dir, DOCSTORE_FNAME))
+    )
+    storage_context = StorageContext.from_defaults(
+        vector_store=FaissVectorStore(faiss_index=faiss_index),
+        docstore=docstore,
+        persist_dir=storage_dir,
+    )
+    return load_index_from_storage(storage_context)
+
+def load_reranker() -> SentenceTransformerRerank | None:
+    """
+    Load the local cross-encoder used to rerank retrieved chunks.
+
+    Returns None when sentence-transformers is not installed or the model
+    cannot be downloaded, in which case plain top-k retrieval is used.
+    """
+    try:
+        return SentenceTransformerRerank(top_n=RERANK_TOP_N, model=RERANK_MODEL)
+    except (ImportError, OSError) as e:
+        logger.info("Reranking disabled (%s); using top-%d retrieval.", e, SIMILARITY_TOP_K)
+        return None
+
+def create_query_engine(
+    index: VectorStoreIndex, reranker: SentenceTransformerRerank | None = None
+):
+    """
+    Create a streaming query engine that answers in a single LLM call.
+
+    With a reranker, more chunks are retrieved and only the most relevant ones
+    are sent to the LLM.
+    """
+    if reranker is None:
+        similarity_top_k = SIMILARITY_TOP_K
+        node_postprocessors = []
+    else:
+        similarity_top_k = RERANK_CANDIDATES
+        node_postprocessors = [reranker]
+
+    return index.as_query_engine(
+        response_mode="compact",
+        similarity_top_k=similarity_top_k,
+        node_postprocessors=node_postprocessors,
+        streaming=True,
+        verbose=False
+    )
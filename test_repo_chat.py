@@ -1,213 +1,349 @@
 import unittest
 import os
-import json
 import tempfile
-import shutil
+from functools import cached_property
+from types import SimpleNamespace
+import subprocess
+import orjson
+import pytest
 import requests
-from unittest.mock import patch, MagicMock
-from datetime import datetime
+from unittest.mock import patch, mock_open, call, MagicMock, AsyncMock
 
+import repo_chat
 from repo_chat import (
     get_latest_commit_sha,
     needs_reindex,
+    parse_repo_url,
     save_metadata,
-    chat_with_github_repo
+    chat_with_github_repo,
+    _clone_repo,
+    load_repo_documents,
+    _make_prompt,
+    EMBED_MODEL,
+    VECTOR_STORE_KIND
 )
 
+_FIXED_TS = "2024-01-01T00:00:00+00:00"
+_META_SAME = orjson.dumps({
+    "last_commit_sha": "abc123def456",
+    "last_indexed": _FIXED_TS,
+    "embed_model": EMBED_MODEL,
+    "vector_store": VECTOR_STORE_KIND,
+    "owner": "testowner",
+    "repo": "testrepo"
+})
+_META_OLD_SHA = _META_SAME.replace(b"abc123def456", b"old_sha")
+_META_OTHER_MODEL = _META_SAME.replace(EMBED_MODEL.encode(), b"text-embedding-ada-002")
+# Exactly what save_metadata writes for the test repository at _FIXED_TS
+_EXPECTED_META_BYTES = f"""{{
+  "last_commit_sha": "abc123def456",
+  "etag": "\\"etag123\\"",
+  "last_indexed": "{_FIXED_TS}",
+  "embed_model": "{EMBED_MODEL}",
+  "vector_store": "{VECTOR_STORE_KIND}",
+  "owner": "testowner",
+  "repo": "testrepo"
+}}""".encode()
+
+# Index, query engine and streamed response shared by the chat tests
+_RESPONSE = MagicMock()
+_RESPONSE.print_response_stream = AsyncMock()
+_QE = MagicMock()
+_QE.aquery = AsyncMock(return_value=_RESPONSE)
+_IDX = MagicMock()
+_IDX.as_query_engine.return_value = _QE
+
+
+_datetime_patcher = patch('repo_chat.datetime')
+
+
+def setUpModule():
+    """Freeze the timestamp save_metadata records for every test in the module."""
+    mock_datetime = _datetime_patcher.start()
+    mock_datetime.now.return_value.isoformat.return_value = _FIXED_TS
+
+
+def tearDownModule():
+    _datetime_patcher.stop()
+
+
+def _reset_query_mocks():
+    """Clear recorded calls on the shared mocks, keeping their configuration."""
+    for mock in (_IDX, _QE, _RESPONSE):
+        mock.reset_mock()
+
+
+class TestRepoChat(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Create one scratch directory, GitHub session and response shared by all test methods."""
+        cls._tmp = tempfile.TemporaryDirectory()
+        cls.mock_session = cls.enterClassContext(
+            patch.object(repo_chat, 'GITHUB_SESSION', new_callable=lambda: MagicMock(spec=['get']))
+        )
+        cls.enterClassContext(patch('repo_chat.load_dotenv', autospec=True))
+        cls.mock_response = MagicMock(spec=requests.Response)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
 
-class TestRepoChat(unittest.TestCase):
     def setUp(self):
         """Set up test fixtures before each test method."""
         self.test_owner = "testowner"
         self.test_repo = "testrepo"
         self.test_token = "fake_token"
         self.test_sha = "abc123def456"
-        self.temp_dir = tempfile.mkdtemp()
-        
-    def tearDown(self):
-        """Clean up after each test method."""
-        if os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
-
-    @patch('requests.get')
-    def test_get_latest_commit_sha_success(self, mock_get):
-        """Test successful retrieval of commit SHA."""
-        # Mock successful API response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "commit": {"sha": self.test_sha}
-        }
-        mock_get.return_value = mock_response
-        
-        result = get_latest_commit_sha(self.test_token, self.test_owner, self.test_repo)
-        
-        self.assertEqual(result, self.test_sha)
-        mock_get.assert_called_once_with(
-            f"https://api.github.com/repos/{self.test_owner}/{self.test_repo}/branches/main",
-            headers={"Authorization": f"token {self.test_token}"},
-            timeout=10
-        )
+        # Never created on disk: tests using it mock open()
+        self.storage_dir = os.path.join("storage", f"{self.test_owner}_{self.test_repo}")
+
+        self.mock_session.reset_mock(return_value=True, side_effect=True)
+        self.mock_response.reset_mock(return_value=True, side_effect=True)
+        self.mock_response.headers = {}
+        self.mock_get = self.mock_session.get
+        self.mock_get.return_value = self.mock_response
+
+    @cached_property
+    def temp_dir(self):
+        """Scratch directory for this test, created on first access only."""
+        path = os.path.join(self._tmp.name, self.id())
+        os.mkdir(path)
+        return path
 
-    @patch('requests.get')
-    def test_get_latest_commit_sha_no_token(self, mock_get):
+    def test_get_latest_commit_sha(self):
+        """Test commit SHA retrieval for successful, failed and erroring requests."""
+        cases = [
+            ("ok", 200, {"commit": {"sha": self.test_sha}}, None, (self.test_sha, '"etag123"')),
+            ("404", 404, None, None, (None, None)),
+            ("exc", None, None, requests.RequestException("Network error"), (None, None)),
+        ]
+        
+        for name, status_code, payload, error, expected in cases:
+            with self.subTest(case=name):
+                self.mock_get.reset_mock(side_effect=True)
+                self.mock_get.side_effect = error
+                self.mock_get.return_value = SimpleNamespace(
+                    status_code=status_code,
+                    headers={"ETag": '"etag123"'},
+                    json=lambda: payload
+                )
+                
+                result = get_latest_commit_sha(self.test_token, self.test_owner, self.test_repo)
+                
+                self.assertEqual(result, expected)
+                self.assertEqual(self.mock_get.call_count, 1)
+                self.assertEqual(self.mock_get.call_args, call(
+                    f"https://api.github.com/repos/{self.test_owner}/{self.test_repo}/branches/main",
+                    headers={"Authorization": f"token {self.test_token}"},
+                    timeout=10
+                ))
+
+    def test_get_latest_commit_sha_no_token(self):
         """Test commit SHA retrieval without token."""
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "commit": {"sha": self.test_sha}
-        }
-        mock_get.return_value = mock_response
+        self.mock_get.return_value = SimpleNamespace(
+            status_code=200,
+            headers={},
+            json=lambda: {"commit": {"sha": self.test_sha}}
+        )
         
         result = get_latest_commit_sha(None, self.test_owner, self.test_repo)
         
-        self.assertEqual(result, self.test_sha)
-        mock_get.assert_called_once_with(
+        self.assertEqual(result, (self.test_sha, None))
+        self.assertEqual(self.mock_get.call_count, 1)
+        self.assertEqual(self.mock_get.call_args, call(
             f"https://api.github.com/repos/{self.test_owner}/{self.test_repo}/branches/main",
             headers={},
             timeout=10
-        )
+        ))
 
-    @patch('requests.get')
-    def test_get_latest_commit_sha_api_error(self, mock_get):
-        """Test commit SHA retrieval with API error."""
-        mock_response = MagicMock()
-        mock_response.status_code = 404
-        mock_get.return_value = mock_response
+    def test_get_latest_commit_sha_not_modified(self):
+        """Test conditional commit SHA retrieval when the branch is unchanged."""
+        self.mock_response.status_code = 304
         
-        result = get_latest_commit_sha(self.test_token, self.test_owner, self.test_repo)
+        result = get_latest_commit_sha(
+            self.test_token, self.test_owner, self.test_repo,
+            known_sha=self.test_sha, etag='"etag123"'
+        )
         
-        self.assertIsNone(result)
+        self.assertEqual(result, (self.test_sha, '"etag123"'))
+        self.mock_response.json.assert_not_called()
+        self.assertEqual(self.mock_get.call_count, 1)
+        self.assertEqual(self.mock_get.call_args, call(
+            f"https://api.github.com/repos/{self.test_owner}/{self.test_repo}/branches/main",
+            headers={
+                "Authorization": f"token {self.test_token}",
+                "If-None-Match": '"etag123"'
+            },
+            timeout=10
+        ))
 
-    @patch('requests.get')
-    def test_get_latest_commit_sha_exception(self, mock_get):
-        """Test commit SHA retrieval with exception."""
-        mock_get.side_effect = requests.RequestException("Network error")
-        
-        result = get_latest_commit_sha(self.test_token, self.test_owner, self.test_repo)
-        
-        self.assertIsNone(result)
+    @patch('repo_chat.subprocess.run')
+    def test_clone_repo_shallow(self, mock_run):
+        """Test that cloning fetches only the latest commit of main."""
+        _clone_repo(self.test_owner, self.test_repo, self.test_token, "checkout")
+
+        command = mock_run.call_args.args[0]
+        self.assertEqual(command[:2], ["git", "clone"])
+        self.assertIn("--depth=1", command)
+        self.assertIn("main", command)
+        self.assertIn(f"github.com/{self.test_owner}/{self.test_repo}.git", command[-2])
+        self.assertEqual(command[-1], "checkout")
+        self.assertFalse(any(self.test_token in arg for arg in command))
+        env = mock_run.call_args.kwargs["env"]
+        self.assertEqual(env["GIT_CONFIG_KEY_0"], "http.extraHeader")
+        self.assertTrue(env["GIT_CONFIG_VALUE_0"].startswith("Authorization: Basic "))
+        self.assertEqual(env["GIT_TERMINAL_PROMPT"], "0")
+
+    @patch('repo_chat.subprocess.run')
+    def test_clone_repo_failure_hides_token(self, mock_run):
+        """Test clone errors are reported without leaking the token."""
+        mock_run.side_effect = subprocess.CalledProcessError(
+            128, "git", stderr=f"fatal: could not read from https://{self.test_token}@github.com"
+        )
+
+        with self.assertRaises(RuntimeError) as context:
+            _clone_repo(self.test_owner, self.test_repo, self.test_token, "checkout")
+
+        self.assertIn("Failed to clone", str(context.exception))
+        self.assertNotIn(self.test_token, str(context.exception))
+
+    @patch('repo_index.load_documents')
+    @patch('repo_chat.subprocess.run')
+    @patch('repo_chat._clone_repo')
+    def test_load_repo_documents_returns_cloned_commit(self, mock_clone, mock_run, mock_load):
+        """Test that documents come back with the SHA checked out in the clone."""
+        mock_run.return_value = SimpleNamespace(stdout=f"{self.test_sha}\n")
+        
+        documents, sha = load_repo_documents(self.test_owner, self.test_repo, self.test_token)
+        
+        self.assertIs(documents, mock_load.return_value)
+        self.assertEqual(sha, self.test_sha)
+        clone_dir = mock_clone.call_args.args[3]
+        self.assertEqual(mock_run.call_args.args[0], ["git", "-C", clone_dir, "rev-parse", "HEAD"])
+
+    @patch.dict('sys.modules', {'prompt_toolkit': None})
+    def test_make_prompt_without_prompt_toolkit(self):
+        """Test that interactive input falls back to input() without prompt_toolkit."""
+        self.assertIs(_make_prompt(), input)
 
     def test_needs_reindex_no_metadata_file(self):
         """Test needs_reindex when metadata file doesn't exist."""
         storage_dir = os.path.join(self.temp_dir, "nonexistent")
         
-        result = needs_reindex(storage_dir, self.test_token, self.test_owner, self.test_repo)
+        should_reindex, current_sha, etag = needs_reindex(
+            storage_dir, self.test_token, self.test_owner, self.test_repo
+        )
+        
+        self.assertTrue(should_reindex)
+        self.assertIsNone(current_sha)
+
+    def test_needs_reindex_empty_storage_dir(self):
+        """Test needs_reindex when the storage directory exists without metadata."""
+        should_reindex, current_sha, etag = needs_reindex(
+            self.temp_dir, self.test_token, self.test_owner, self.test_repo
+        )
         
-        self.assertTrue(result)
+        self.assertTrue(should_reindex)
+        self.assertIsNone(current_sha)
 
+    @patch('repo_chat.open', new_callable=mock_open, read_data=_META_SAME, create=True)
+    @patch('repo_chat.os.path.exists', return_value=True)
     @patch('repo_chat.get_latest_commit_sha')
-    def test_needs_reindex_same_sha(self, mock_get_sha):
+    def test_needs_reindex_same_sha(self, mock_get_sha, mock_exists, mock_file):
         """Test needs_reindex when SHA hasn't changed."""
-        storage_dir = os.path.join(self.temp_dir, "test_storage")
-        os.makedirs(storage_dir)
+        mock_get_sha.return_value = (self.test_sha, '"etag123"')
         
-        # Create metadata file with test SHA
-        metadata = {
-            "last_commit_sha": self.test_sha,
-            "last_indexed": datetime.now().isoformat(),
-            "owner": self.test_owner,
-            "repo": self.test_repo
-        }
-        metadata_file = os.path.join(storage_dir, "metadata.json")
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f)
-        
-        mock_get_sha.return_value = self.test_sha
-        
-        result = needs_reindex(storage_dir, self.test_token, self.test_owner, self.test_repo)
+        should_reindex, current_sha, etag = needs_reindex(
+            self.storage_dir, self.test_token, self.test_owner, self.test_repo
+        )
         
-        self.assertFalse(result)
+        self.assertFalse(should_reindex)
+        self.assertEqual(current_sha, self.test_sha)
+        self.assertEqual(etag, '"etag123"')
+        mock_file.assert_called_once_with(os.path.join(self.storage_dir, "metadata.json"), "rb")
+        mock_get_sha.assert_called_once_with(
+            self.test_token, self.test_owner, self.test_repo,
+            known_sha=self.test_sha, etag=None
+        )
 
+    @patch('repo_chat.open', new_callable=mock_open, read_data=_META_OLD_SHA, create=True)
+    @patch('repo_chat.os.path.exists', return_value=True)
     @patch('repo_chat.get_latest_commit_sha')
-    def test_needs_reindex_different_sha(self, mock_get_sha):
+    def test_needs_reindex_different_sha(self, mock_get_sha, mock_exists, mock_file):
         """Test needs_reindex when SHA has changed."""
-        storage_dir = os.path.join(self.temp_dir, "test_storage")
-        os.makedirs(storage_dir)
+        mock_get_sha.return_value = (self.test_sha, '"etag123"')
         
-        # Create metadata file with old SHA
-        metadata = {
-            "last_commit_sha": "old_sha",
-            "last_indexed": datetime.now().isoformat(),
-            "owner": self.test_owner,
-            "repo": self.test_repo
-        }
-        metadata_file = os.path.join(storage_dir, "metadata.json")
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f)
+        should_reindex, current_sha, etag = needs_reindex(
+            self.storage_dir, self.test_token, self.test_owner, self.test_repo
+        )
         
-        mock_get_sha.return_value = self.test_sha
+        self.assertTrue(should_reindex)
+        self.assertEqual(current_sha, self.test_sha)
+
+    @patch('repo_chat.open', new_callable=mock_open, read_data=_META_OTHER_MODEL, create=True)
+    @patch('repo_chat.os.path.exists', return_value=True)
+    @patch('repo_chat.get_latest_commit_sha')
+    def test_needs_reindex_embed_model_changed(self, mock_get_sha, mock_exists, mock_file):
+        """Test needs_reindex when the index was built with another embedding model."""
+        mock_get_sha.return_value = (self.test_sha, '"etag123"')
         
-        result = needs_reindex(storage_dir, self.test_token, self.test_owner, self.test_repo)
+        should_reindex, current_sha, etag = needs_reindex(
+            self.storage_dir, self.test_token, self.test_owner, self.test_repo
+        )
         
-        self.assertTrue(result)
+        self.assertTrue(should_reindex)
+        self.assertIsNone(current_sha)
 
+    @patch('repo_chat.open', new_callable=mock_open, read_data=b"invalid json", create=True)
+    @patch('repo_chat.os.path.exists', return_value=True)
     @patch('repo_chat.get_latest_commit_sha')
-    def test_needs_reindex_corrupted_metadata(self, mock_get_sha):
+    def test_needs_reindex_corrupted_metadata(self, mock_get_sha, mock_exists, mock_file):
         """Test needs_reindex with corrupted metadata file."""
-        storage_dir = os.path.join(self.temp_dir, "test_storage")
-        os.makedirs(storage_dir)
-        
-        # Create corrupted metadata file
-        metadata_file = os.path.join(storage_dir, "metadata.json")
-        with open(metadata_file, 'w') as f:
-            f.write("invalid json")
-        
-        result = needs_reindex(storage_dir, self.test_token, self.test_owner, self.test_repo)
+        should_reindex, current_sha, etag = needs_reindex(
+            self.storage_dir, self.test_token, self.test_owner, self.test_repo
+        )
         
-        self.assertTrue(result)
+        self.assertTrue(should_reindex)
+        self.assertIsNone(current_sha)
+        mock_get_sha.assert_not_called()
 
-    @patch('repo_chat.get_latest_commit_sha')
-    def test_save_metadata(self, mock_get_sha):
+    def test_save_metadata(self):
         """Test saving metadata to file."""
-        storage_dir = os.path.join(self.temp_dir, "test_storage")
-        os.makedirs(storage_dir)
-        
-        mock_get_sha.return_value = self.test_sha
-        
-        save_metadata(storage_dir, self.test_token, self.test_owner, self.test_repo)
+        metadata_file = mock_open()
         
-        metadata_file = os.path.join(storage_dir, "metadata.json")
-        self.assertTrue(os.path.exists(metadata_file))
+        with patch('repo_chat.open', metadata_file, create=True):
+            save_metadata(self.storage_dir, self.test_sha, self.test_owner, self.test_repo, '"etag123"')
         
-        with open(metadata_file, 'r') as f:
-            metadata = json.load(f)
-        
-        self.assertEqual(metadata["last_commit_sha"], self.test_sha)
-        self.assertEqual(metadata["owner"], self.test_owner)
-        self.assertEqual(metadata["repo"], self.test_repo)
-        self.assertIn("last_indexed", metadata)
+        metadata_file.assert_called_once_with(os.path.join(self.storage_dir, "metadata.json"), "wb")
+        metadata_file().write.assert_called_once_with(_EXPECTED_META_BYTES)
 
-    @patch('repo_chat.load_dotenv')
     @patch('repo_chat.os.getenv')
-    def test_chat_with_github_repo_missing_openai_key(self, mock_getenv, mock_load_dotenv):
+    async def test_chat_with_github_repo_missing_openai_key(self, mock_getenv):
         """Test chat function with missing OpenAI API key."""
         mock_getenv.side_effect = lambda key: None if key == "OPENAI_API_KEY" else "fake_token"
         
         with self.assertRaises(ValueError) as context:
-            chat_with_github_repo("https://github.com/owner/repo", "test question")
+            await chat_with_github_repo("https://github.com/owner/repo", "test question")
         
         self.assertIn("OpenAI API key not found", str(context.exception))
 
-    @patch('repo_chat.load_dotenv')
     @patch('repo_chat.os.getenv')
-    def test_chat_with_github_repo_missing_github_token(self, mock_getenv, mock_load_dotenv):
+    async def test_chat_with_github_repo_missing_github_token(self, mock_getenv):
         """Test chat function with missing GitHub token."""
         mock_getenv.side_effect = lambda key: "fake_openai_key" if key == "OPENAI_API_KEY" else None
         
         with self.assertRaises(ValueError) as context:
-            chat_with_github_repo("https://github.com/owner/repo", "test question")
+            await chat_with_github_repo("https://github.com/owner/repo", "test question")
         
         self.assertIn("GitHub token not found", str(context.exception))
 
-    @patch('repo_chat.load_dotenv')
     @patch('repo_chat.os.getenv')
+    @patch('repo_index.SentenceTransformerRerank', new=MagicMock(side_effect=ImportError))
     @patch('repo_chat.needs_reindex')
-    @patch('repo_chat.load_index_from_storage')
-    @patch('repo_chat.StorageContext.from_defaults')
+    @patch('repo_index.load_index')
     @patch('os.path.exists')
-    def test_chat_with_github_repo_load_existing_index(
-        self, mock_exists, mock_storage_context, mock_load_index, mock_needs_reindex, mock_getenv, mock_load_dotenv
+    async def test_chat_with_github_repo_load_existing_index(
+        self, mock_exists, mock_load_index, mock_needs_reindex, mock_getenv
     ):
         """Test chat function loading existing index."""
         # Mock environment variables
@@ -218,107 +354,140 @@ class TestRepoChat(unittest.TestCase):
         
         # Mock existing storage and no reindex needed
         mock_exists.return_value = True
-        mock_needs_reindex.return_value = False
+        mock_needs_reindex.return_value = (False, "abc123", '"etag123"')
         
-        # Mock index and query engine
-        mock_index = MagicMock()
-        mock_query_engine = MagicMock()
-        mock_query_engine.query.return_value = "Test response"
-        mock_index.as_query_engine.return_value = mock_query_engine
-        mock_load_index.return_value = mock_index
+        _reset_query_mocks()
+        mock_load_index.return_value = _IDX
         
         # Mock stdout to capture prints
-        with patch('builtins.print'):
-            chat_with_github_repo("https://github.com/owner/repo", "test question")
+        with patch('builtins.print'), self.assertLogs("repo_chat", level="INFO") as logs:
+            await chat_with_github_repo("https://github.com/owner/repo", "test question")
         
+        self.assertIn("INFO:repo_chat:Loading existing index for owner/repo...", logs.output)
         # Verify index was loaded, not created
-        mock_load_index.assert_called_once()
-        mock_query_engine.query.assert_called_once_with("test question")
-
-    def test_url_parsing(self):
-        """Test URL parsing for owner and repo extraction."""
-        test_urls = [
-            ("https://github.com/owner/repo", ("owner", "repo")),
-            ("https://github.com/test-owner/test-repo", ("test-owner", "test-repo")),
-            ("github.com/user/project", ("user", "project"))
-        ]
+        mock_load_index.assert_called_once_with("./storage/owner_repo")
+        self.assertTrue(_IDX.as_query_engine.call_args.kwargs["streaming"])
+        _QE.aquery.assert_awaited_once_with("test question")
+        _RESPONSE.print_response_stream.assert_awaited_once()
+
+    @patch('repo_chat.os.getenv')
+    @patch('repo_index.SentenceTransformerRerank', new=MagicMock(side_effect=ImportError))
+    @patch('repo_index.configure_embeddings')
+    @patch('repo_chat.needs_reindex', return_value=(False, "abc123", '"etag123"'))
+    @patch('repo_index.load_index', return_value=_IDX)
+    @patch('os.path.exists', return_value=True)
+    async def test_chat_with_github_repo_extra_openai_keys(
+        self, mock_exists, mock_load_index, mock_needs_reindex, mock_configure, mock_getenv
+    ):
+        """Test that OPENAI_API_KEYS adds deduplicated keys after the primary key."""
+        mock_getenv.side_effect = lambda key: {
+            "OPENAI_API_KEY": "fake_openai_key",
+            "OPENAI_API_KEYS": " key_two, fake_openai_key,,key_three,key_two ",
+            "GITHUB_TOKEN": "fake_github_token"
+        }.get(key)
+        _reset_query_mocks()
+        
+        with patch('builtins.print'), self.assertLogs("repo_chat", level="INFO"):
+            await chat_with_github_repo("https://github.com/owner/repo", "test question")
         
-        for url, expected in test_urls:
-            owner, repo = url.split("/")[-2:]
-            self.assertEqual((owner, repo), expected)
+        mock_configure.assert_called_once_with(
+            ["fake_openai_key", "key_two", "key_three"], "./storage/owner_repo", EMBED_MODEL
+        )
+
 
+@pytest.mark.parametrize("url,expected", [
+    ("https://github.com/owner/repo", ("owner", "repo")),
+    ("https://github.com/test-owner/test-repo", ("test-owner", "test-repo")),
+    ("github.com/user/project", ("user", "project")),
+    ("https://github.com/user/project/", ("user", "project")),
+    ("https://github.com/user/project.git", ("user", "project")),
+])
+def test_url_parsing(url, expected):
+    """Test URL parsing for owner and repo extraction."""
+    assert parse_repo_url(url) == expected
 
-class TestIntegration(unittest.TestCase):
+
+def test_url_parsing_rejects_other_hosts():
+    """Test that non-GitHub URLs are rejected."""
+    with pytest.raises(ValueError):
+        parse_repo_url("https://gitlab.com/user/project")
+
+
+class TestIntegration(unittest.IsolatedAsyncioTestCase):
     """Integration tests for the complete workflow."""
     
-    def setUp(self):
-        self.temp_dir = tempfile.mkdtemp()
-        
-    def tearDown(self):
-        if os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
+    @pytest.fixture(autouse=True)
+    def _use_tmp_storage(self, tmp_storage):
+        self.temp_dir = str(tmp_storage)
 
     @patch.dict(os.environ, {
         'OPENAI_API_KEY': 'fake_openai_key',
         'GITHUB_TOKEN': 'fake_github_token'
     })
-    @patch('repo_chat.GithubRepositoryReader')
-    @patch('repo_chat.VectorStoreIndex.from_documents')
+    @patch('repo_index.SentenceTransformerRerank', new=MagicMock(side_effect=ImportError))
+    @patch('repo_chat.load_repo_documents')
+    @patch('repo_index.embed_documents', new_callable=AsyncMock)
+    @patch('repo_index.build_index')
     @patch('repo_chat.get_latest_commit_sha')
-    def test_full_workflow_new_repository(self, mock_get_sha, mock_vector_index, mock_github_reader):
+    async def test_full_workflow_new_repository(
+        self, mock_get_sha, mock_build_index, mock_embed_documents, mock_load_documents
+    ):
         """Test complete workflow for a new repository."""
         # Setup mocks
-        mock_get_sha.return_value = "abc123"
+        mock_get_sha.return_value = ("abc123", '"etag123"')
         
         mock_documents = [MagicMock()]
-        mock_loader = MagicMock()
-        mock_loader.load_data.return_value = mock_documents
-        mock_github_reader.return_value = mock_loader
-        
-        mock_index = MagicMock()
-        mock_query_engine = MagicMock()
-        mock_query_engine.query.return_value = "This is a test repository"
-        mock_index.as_query_engine.return_value = mock_query_engine
-        mock_vector_index.return_value = mock_index
-        
-        # Change to temp directory for storage
-        original_cwd = os.getcwd()
-        os.chdir(self.temp_dir)
-        
-        try:
-            with patch('builtins.print'):
-                chat_with_github_repo("https://github.com/test/repo", "What does this repo do?")
-            
-            # Verify storage was created
-            storage_dir = "./storage/test_repo"
-            self.assertTrue(os.path.exists(storage_dir))
-            
-            # Verify metadata was saved
-            metadata_file = os.path.join(storage_dir, "metadata.json")
-            self.assertTrue(os.path.exists(metadata_file))
-            
-            with open(metadata_file, 'r') as f:
-                metadata = json.load(f)
-            self.assertEqual(metadata["last_commit_sha"], "abc123")
-            self.assertEqual(metadata["owner"], "test")
-            self.assertEqual(metadata["repo"], "repo")
-            
-        finally:
-            os.chdir(original_cwd)
-
-
-if __name__ == '__main__':
-    # Create test suite
-    loader = unittest.TestLoader()
-    suite = unittest.TestSuite()
-    
-    # Add test cases
-    suite.addTests(loader.loadTestsFromTestCase(TestRepoChat))
-    suite.addTests(loader.loadTestsFromTestCase(TestIntegration))
-    
-    # Run tests
-    runner = unittest.TextTestRunner(verbosity=2)
-    result = runner.run(suite)
-    
-    # Exit with appropriate code
-    exit(0 if result.wasSuccessful() else 1)
+        mock_load_documents.return_value = (mock_documents, "abc123")
+        mock_nodes = [MagicMock()]
+        mock_embed_documents.return_value = mock_nodes
+        
+        _reset_query_mocks()
+        mock_build_index.return_value = _IDX
+        
+        with patch('builtins.print'):
+            await chat_with_github_repo("https://github.com/test/repo", "What does this repo do?")
+        
+        mock_load_documents.assert_called_once_with("test", "repo", "fake_github_token")
+        mock_embed_documents.assert_awaited_once_with(mock_documents)
+        mock_build_index.assert_called_once_with(mock_nodes)
+        _QE.aquery.assert_awaited_once_with("What does this repo do?")
+        mock_get_sha.assert_called_once_with("fake_github_token", "test", "repo")
+        
+        # Verify storage was created with the metadata in it
+        with os.scandir(os.path.join(self.temp_dir, "test_repo")) as it:
+            entries = {entry.name: entry for entry in it}
+        self.assertIn("metadata.json", entries)
+        
+        with open(entries["metadata.json"].path, 'rb') as f:
+            metadata = orjson.loads(f.read())
+        self.assertEqual(metadata["last_commit_sha"], "abc123")
+        self.assertEqual(metadata["etag"], '"etag123"')
+        self.assertEqual(metadata["last_indexed"], _FIXED_TS)
+        self.assertEqual(metadata["owner"], "test")
+        self.assertEqual(metadata["repo"], "repo")
+
+    @patch.dict(os.environ, {
+        'OPENAI_API_KEY': 'fake_openai_key',
+        'GITHUB_TOKEN': 'fake_github_token'
+    })
+    @patch('repo_index.SentenceTransformerRerank', new=MagicMock(side_effect=ImportError))
+    @patch('repo_chat.load_repo_documents')
+    @patch('repo_index.embed_documents', new_callable=AsyncMock)
+    @patch('repo_index.build_index')
+    @patch('repo_chat.get_latest_commit_sha')
+    async def test_push_during_clone_records_cloned_commit(
+        self, mock_get_sha, mock_build_index, mock_embed_documents, mock_load_documents
+    ):
+        """Test that metadata records the cloned commit, not a newer API answer."""
+        mock_get_sha.return_value = ("def456", '"etag456"')
+        mock_load_documents.return_value = ([MagicMock()], "abc123")
+        _reset_query_mocks()
+        mock_build_index.return_value = _IDX
+        
+        with patch('builtins.print'):
+            await chat_with_github_repo("https://github.com/test/repo", "What does this repo do?")
+        
+        with open(os.path.join(self.temp_dir, "test_repo", "metadata.json"), 'rb') as f:
+            metadata = orjson.loads(f.read())
+        self.assertEqual(metadata["last_commit_sha"], "abc123")
+        self.assertIsNone(metadata["etag"])
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from functools import cached_property
+from unittest.mock import patch, MagicMock
+
+import faiss
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+from repo_index import (
+    OrjsonKVStore,
+    build_index,
+    CachedOpenAIEmbedding,
+    create_query_engine,
+    create_vector_store,
+    load_documents,
+    load_index,
+    load_reranker,
+    FAISS_INDEX_FILE
+)
+
+
+class TestRepoIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Create one scratch directory shared by all test methods."""
+        cls._tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
+    @cached_property
+    def temp_dir(self):
+        """Scratch directory for this test, created on first access only."""
+        path = os.path.join(self._tmp.name, self.id())
+        os.mkdir(path)
+        return path
+
+    def _embed_model(self, **kwargs) -> CachedOpenAIEmbedding:
+        """Create a cached embedding model whose cache lives in the test directory."""
+        kwargs.setdefault("api_key", "fake_openai_key")
+        return CachedOpenAIEmbedding(
+            cache_path=os.path.join(self.temp_dir, "embed_cache.sqlite"),
+            model="text-embedding-3-small",
+            **kwargs
+        )
+
+    def test_load_documents_skips_binary_and_generated_files(self):
+        """Test that only source files reach the embedding step."""
+        files = {
+            "main.py": b"print('hello')\n",
+            "docs/guide.md": b"# Guide\n",
+            "package-lock.json": b"{}",
+            "static/app.min.js": b"var a=1;",
+            "data.bin": b"\x89PNG\0\0\0",
+            "big.txt": b"x" * 200_001,
+            "node_modules/lib/index.js": b"module.exports = 1;",
+            ".github/workflows/ci.yml": b"on: push\n",
+            ".git/HEAD": b"ref: refs/heads/main\n",
+        }
+        for relative_path, content in files.items():
+            path = os.path.join(self.temp_dir, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+        
+        documents = load_documents(self.temp_dir)
+        
+        self.assertEqual(
+            [document.metadata["file_path"] for document in documents],
+            [".github/workflows/ci.yml", "docs/guide.md", "main.py"]
+        )
+
+    def test_load_documents_reads_every_file_as_plain_text(self):
+        """Test that notebooks and CSV files are indexed verbatim, not parsed."""
+        files = {
+            "demo.ipynb": '{"cells": [], "nbformat": 4}',
+            "data.csv": "name,value\nfoo,1\n",
+        }
+        for name, content in files.items():
+            with open(os.path.join(self.temp_dir, name), "w", encoding="utf-8") as f:
+                f.write(content)
+        
+        documents = load_documents(self.temp_dir)
+        
+        self.assertEqual(
+            {document.metadata["file_name"]: document.text for document in documents},
+            files
+        )
+
+    @patch('repo_index.OpenAIEmbedding._get_text_embeddings')
+    def test_cached_embedding_reuses_vectors(self, mock_embed):
+        """Test that unchanged chunks are served from the embedding cache."""
+        mock_embed.side_effect = lambda texts: [[0.5, 0.25] for _ in texts]
+        embed_model = self._embed_model()
+        
+        first = embed_model._get_text_embeddings(["def foo(): pass", "README"])
+        second = embed_model._get_text_embeddings(["README", "new chunk"])
+        
+        self.assertEqual(first, [[0.5, 0.25], [0.5, 0.25]])
+        self.assertEqual(second, [[0.5, 0.25], [0.5, 0.25]])
+        self.assertEqual(mock_embed.call_count, 2)
+        self.assertEqual(mock_embed.call_args.args[0], ["new chunk"])
+
+    @patch('repo_index.OpenAIEmbedding._get_text_embeddings')
+    def test_cached_embedding_prunes_unused_vectors(self, mock_embed):
+        """Test that pruning keeps only the embeddings of the current chunks."""
+        mock_embed.side_effect = lambda texts: [[0.5, 0.25] for _ in texts]
+        embed_model = self._embed_model()
+        embed_model._get_text_embeddings(["old chunk", "kept chunk"])
+        
+        embed_model.prune_cache(["kept chunk"])
+        embed_model._get_text_embeddings(["old chunk", "kept chunk"])
+        
+        self.assertEqual(mock_embed.call_args.args[0], ["old chunk"])
+
+    @patch('repo_index.OpenAIEmbedding._aget_text_embeddings')
+    def test_cached_embedding_embeds_duplicates_once(self, mock_embed):
+        """Test that identical chunks cost a single embedding."""
+        mock_embed.side_effect = lambda texts: [[float(len(text)), 0.0] for text in texts]
+        embed_model = self._embed_model()
+        
+        result = asyncio.run(
+            embed_model.aget_text_embedding_batch(["# MIT License", "x = 1", "# MIT License"])
+        )
+        
+        self.assertEqual(result, [[13.0, 0.0], [5.0, 0.0], [13.0, 0.0]])
+        mock_embed.assert_called_once_with(["# MIT License", "x = 1"])
+
+    @patch('repo_index.aget_embeddings')
+    def test_cached_embedding_round_robins_api_keys(self, mock_aget):
+        """Test that uncached batches are spread across all configured keys."""
+        mock_aget.side_effect = lambda client, texts, **kwargs: [[1.0, 0.0]] * len(texts)
+        embed_model = self._embed_model(api_keys=["key_one", "key_two"], api_key="key_one")
+        
+        async def embed_batches():
+            for text in ["a = 1", "b = 2", "c = 3"]:
+                await embed_model.aget_text_embedding_batch([text])
+        asyncio.run(embed_batches())
+        
+        used_keys = [call.args[0].api_key for call in mock_aget.call_args_list]
+        self.assertEqual(used_keys, ["key_one", "key_two", "key_one"])
+
+    def test_create_vector_store_small_repo_uses_hnsw(self):
+        """Test that small repositories get a full-precision HNSW index."""
+        vector_store = create_vector_store([[0.0] * 1536] * 10)
+        
+        self.assertIsInstance(vector_store.client, faiss.IndexHNSWFlat)
+
+    @patch('repo_index.IVFPQ_MIN_VECTORS', 300)
+    def test_create_vector_store_large_repo_uses_ivfpq(self):
+        """Test that large repositories get a trained product-quantized index."""
+        embeddings = np.random.default_rng(0).random((300, 1536), dtype="float32").tolist()
+        
+        with patch('repo_index.IVF_NLIST', 4):
+            vector_store = create_vector_store(embeddings)
+        
+        self.assertIsInstance(vector_store.client, faiss.IndexIVFPQ)
+        self.assertTrue(vector_store.client.is_trained)
+        self.assertEqual(vector_store.client.nprobe, 16)
+
+    def test_create_query_engine_with_reranker(self):
+        """Test that retrieved chunks are reranked before a single compact LLM call."""
+        mock_index = MagicMock()
+        reranker = MagicMock()
+        
+        create_query_engine(mock_index, reranker)
+        
+        kwargs = mock_index.as_query_engine.call_args.kwargs
+        self.assertEqual(kwargs["response_mode"], "compact")
+        self.assertEqual(kwargs["similarity_top_k"], 20)
+        self.assertEqual(kwargs["node_postprocessors"], [reranker])
+
+    def test_create_query_engine_without_reranker(self):
+        """Test plain top-k retrieval when no reranker is available."""
+        mock_index = MagicMock()
+        
+        create_query_engine(mock_index)
+        
+        kwargs = mock_index.as_query_engine.call_args.kwargs
+        self.assertEqual(kwargs["response_mode"], "compact")
+        self.assertEqual(kwargs["similarity_top_k"], 10)
+        self.assertEqual(kwargs["node_postprocessors"], [])
+
+    @patch('repo_index.SentenceTransformerRerank')
+    def test_load_reranker(self, mock_rerank):
+        """Test that the cross-encoder reranker is built with the configured model."""
+        self.assertIs(load_reranker(), mock_rerank.return_value)
+        mock_rerank.assert_called_once_with(
+            top_n=4, model="cross-encoder/ms-marco-MiniLM-L-6-v2"
+        )
+
+    def test_load_reranker_unavailable(self):
+        """Test the fallback when sentence-transformers or the model is unavailable."""
+        for error in (ImportError("no sentence-transformers"), OSError("hub unreachable")):
+            with self.subTest(error=type(error).__name__), \
+                    patch('repo_index.SentenceTransformerRerank', side_effect=error), \
+                    self.assertLogs("repo_chat.index", level="INFO"):
+                self.assertIsNone(load_reranker())
+
+    @patch('repo_index.load_index_from_storage')
+    @patch('repo_index.StorageContext.from_defaults')
+    def test_load_index_memory_maps_faiss_store(self, mock_storage_context, mock_load_index):
+        """Test that persisted FAISS vectors are memory-mapped on load."""
+        vector_store = create_vector_store([[0.0] * 1536] * 10)
+        vector_store.persist(os.path.join(self.temp_dir, FAISS_INDEX_FILE))
+        OrjsonKVStore().persist(os.path.join(self.temp_dir, "docstore.json"))
+        
+        with patch('repo_index.faiss.read_index', wraps=faiss.read_index) as mock_read_index:
+            result = load_index(self.temp_dir)
+        
+        mock_read_index.assert_called_once_with(
+            os.path.join(self.temp_dir, FAISS_INDEX_FILE),
+            faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+        )
+        loaded_store = mock_storage_context.call_args.kwargs["vector_store"]
+        self.assertIsInstance(loaded_store.client, faiss.IndexHNSWFlat)
+        self.assertEqual(mock_storage_context.call_args.kwargs["persist_dir"], self.temp_dir)
+        self.assertIs(result, mock_load_index.return_value)
+
+    @patch.object(Settings, '_embed_model', new=MockEmbedding(embed_dim=1536))
+    def test_index_round_trip_uses_orjson_docstore(self):
+        """Test that a persisted index, with its orjson-written docstore, loads back."""
+        nodes = [TextNode(text=f"chunk {i}", embedding=[float(i)] * 1536) for i in range(3)]
+        
+        build_index(nodes).storage_context.persist(persist_dir=self.temp_dir)
+        # Still plain JSON, so indexes stay readable by the stock loader
+        with open(os.path.join(self.temp_dir, "docstore.json"), encoding="utf-8") as f:
+            json.load(f)
+        index = load_index(self.temp_dir)
+        
+        self.assertIsInstance(index.docstore._kvstore, OrjsonKVStore)
+        self.assertEqual(
+            sorted(node.text for node in index.docstore.docs.values()),
+            ["chunk 0", "chunk 1", "chunk 2"]
+        )